@@ -1,81 +1,205 @@
-# Python >= 3.6 for f-strings
+# Python >= 3.9, for ThreadPoolExecutor.shutdown(cancel_futures=True)
+from collections import Counter
 from collections import defaultdict
-from csv import DictReader
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from csv import reader
 from csv import writer
 from datetime import date
+from functools import lru_cache
 from json import dump
 from json import load
+from operator import itemgetter
+from os import cpu_count
 from os.path import exists
+from os.path import getsize
+from re import compile as re_compile
+from re import MULTILINE
+from subprocess import CalledProcessError
 from subprocess import PIPE
 from subprocess import Popen
-from time import sleep
+
+try: # optional, see write_json
+    from orjson import dumps as orjson_dumps
+    from orjson import OPT_INDENT_2
+    from orjson import OPT_NON_STR_KEYS
+except ImportError:
+    orjson_dumps = None
+
+# The report columns we use, and their positions in the tuples iter_report yields
+COLUMNS = ('Cancelled At', 'Checked In At', 'Location', 'Email', 'From Date', 'From Time')
+CANCELLED_AT, CHECKED_IN_AT, LOCATION, EMAIL, FROM_DATE, FROM_TIME = range(len(COLUMNS))
+
+# Indexed by date.weekday()
+DAYS = ('Monday','Tuesday','Wednesday','Thursday','Friday','Saturday','Sunday')
+# Indexed by hour, e.g. TIME_BLOCKS[9] == '08:00 - 09:59'
+TIME_BLOCKS = tuple(f'{h & ~1:02d}:00 - {(h & ~1) + 1:02d}:59' for h in range(24))
+
+def write_json(obj, pth):
+    # Uses orjson if it's installed. It writes the same thing as json.dump does
+    # here, only much faster, as json drops to pure Python once indent is set.
+    if orjson_dumps is None:
+        with open(pth, 'w') as f:
+            dump(obj, f, ensure_ascii=False, indent=2)
+    else:
+        with open(pth, 'wb') as f:
+            f.write(orjson_dumps(obj, option=OPT_INDENT_2 | OPT_NON_STR_KEYS))
 
 class SeatDataReader():
-    def report_filter(self, r):
-        return (r['Cancelled At'] != '' or r['Checked In At'] != '' or r['Location'] != 'Test Branch')
-
-    def read_report(self, pth):
-        with open(pth) as csv:
-            # Just take the whole thing into memory
-            report = list(DictReader(csv))
-        return report
-
-class IDCache(defaultdict, SeatDataReader):
-    '''A dict-like object with patron statuses (e.g. 'undergraduate') as keys
-    and a list of netids as values.
+    __slots__ = () # so subclasses can do without a __dict__
+
+    def report_filter(self, header):
+        '''Returns a predicate for the rows of a report with this header that
+        we want. Works on the rows as read, so rows we don't want are dropped
+        before we pick out their COLUMNS. Blank lines (i.e. empty rows) are
+        never wanted, as DictReader skipped them.
+        '''
+        cancelled_at, checked_in_at, location = map(header.index, ('Cancelled At', 'Checked In At', 'Location'))
+        return lambda r: r and (r[cancelled_at] != '' or r[checked_in_at] != '' or r[location] != 'Test Branch')
+
+    def iter_report(self, pth, start=None, end=None):
+        '''Yields the reservations in the report at pth that pass report_filter,
+        one at a time, as tuples of the COLUMNS values. If start and end are
+        given, only reads the rows in that byte range (see chunk_offsets).
+        '''
+        with open(pth, newline='') as csv:
+            rows = reader(csv)
+            header = next(rows)
+            columns = itemgetter(*map(header.index, COLUMNS))
+            if start is not None:
+                lines = SeatDataReader._iter_lines(pth, start, end, csv.encoding)
+                rows = reader(lines)
+            yield from map(columns, filter(self.report_filter(header), rows))
+
+    @staticmethod
+    def _iter_lines(pth, start, end, encoding):
+        # Streams the lines in the byte range [start, end) of the file at pth.
+        # Binary mode, as text mode can't tell() us where we are
+        with open(pth, 'rb') as f:
+            f.seek(start)
+            while f.tell() < end:
+                yield f.readline().decode(encoding)
+
+    @staticmethod
+    def chunk_offsets(pth, nchunks):
+        '''Splits the rows (i.e. everything after the header) of the report at
+        pth into at most nchunks byte ranges that start and end on line breaks.
+        Returns a list of (start, end) tuples. Assumes there are no line breaks
+        inside quoted values.
+        '''
+        size = getsize(pth)
+        with open(pth, 'rb') as f:
+            f.readline() # header
+            offsets = [f.tell()]
+            for i in range(1, nchunks):
+                f.seek(max(i * size // nchunks, offsets[-1]))
+                f.readline() # skip ahead to the start of the next line
+                offsets.append(f.tell())
+        offsets.append(size)
+        return [(start, end) for start, end in zip(offsets, offsets[1:]) if start < end]
+
+class IDCache(SeatDataReader):
+    '''Patron statuses (e.g. 'undergraduate') of netids. by_type has statuses
+    as keys and lists of netids as values, and is what's saved to disk.
     '''
+    # Attribute lines in ldapsearch output, e.g. b'pustatus: graduate'
+    _ATTRIBUTE_RE = re_compile(rb'^(\w+):[ \t]*(.*?)\s*$', MULTILINE)
+    _PUSTATUS_RE = re_compile(rb'^pustatus:[ \t]*(.*?)\s*$', MULTILINE)
+    # Cached like any other status for IDs LDAP doesn't know, so they aren't
+    # looked up again on later runs
+    UNKNOWN = 'unknown'
+    __slots__ = ('by_type', 'cache_path', '_index', '_pending')
+
     def __init__(self):
-        super().__init__(list)
+        self.by_type = {}
         self.cache_path = './id_cache.json'
+        self._index = {} # id -> patron status, for constant time lookups
+        self._pending = {} # observed ids to look up; a dict to keep them in order
         if exists(self.cache_path):
             self._load()
 
     def includes(self, id):
-        '''Returns True if this id in _any_ of the dict entries
+        '''Returns True if this id is in _any_ of the by_type entries
         '''
-        return any([id in self[k] for k in self.keys()])
+        return id in self._index
 
     def patron_type(self, id):
-        for k in self.keys():
-            if id in self[k]:
-                return k # will exit loop
+        return self._index.get(id)
+
+    def add(self, id, patron_type):
+        self.by_type.setdefault(patron_type, []).append(id)
+        self._index[id] = patron_type
 
     def _dump(self):
-        with open(self.cache_path, 'w') as f:
-            dump(self, f, ensure_ascii=False, indent=2)
+        write_json(self.by_type, self.cache_path)
 
     def _load(self):
         with open(self.cache_path, 'r') as f:
             for k,v in load(f).items():
-                self[k] = v
+                self.by_type[k] = v
+                for id in v:
+                    self._index[id] = k
+
+    def build(self, report_path, dump_every=200, batch_size=100, workers=16, batch=True):
+        '''Build the cache. Hits LDAP once for each batch of batch_size unknown
+        (to us) IDs, with up to workers batches in flight at a time. With
+        batch=False, the IDs in each batch are looked up one at a time with
+        get_patron_type instead, as this used to do. Note that the cache will be
+        initialzed with the entries in ./id_cache.json if it exists, so calling
+        this method will only hit LDAP for new IDs if this has been run before.
+        IDs LDAP doesn't know are cached as UNKNOWN so they aren't looked up
+        again either, but IDs we couldn't ask LDAP about (i.e. ldapsearch
+        failed) are not cached at all.
+        '''
+        for reservation in self.iter_report(report_path):
+            self.observe(reservation)
+        self.resolve(dump_every, batch_size, workers, batch)
+
+    def observe(self, reservation):
+        '''Note the reservation's ID for the next resolve() if we don't know it
+        yet. Lets the cache be built from a pass over the report shared with
+        other readers.
+        '''
+        self.observe_id(reservation[EMAIL])
 
-    def build(self, report_path, dump_every=200):
-        '''Build the cache. Hits LDAP once for each unknown (to us) ID. Note
-        that the cache will be initialzed with the entries in ./id_cache.json
-        if it exists, so calling this method will only hit LDAP for new IDs if
-        this has been run before.
+    def observe_id(self, id):
+        '''Like observe, for when we just have the ID.
+        '''
+        if not self.includes(id):
+            self._pending[id] = None
+
+    def resolve(self, dump_every=200, batch_size=100, workers=16, batch=True):
+        '''Look up the IDs observed since the last call and add them to the
+        cache. See build() for the arguments.
         '''
         try:
-            report = self.read_report(report_path)
+            emails = list(self._pending)
+            self._pending.clear()
+            batches = [emails[i:i+batch_size] for i in range(0, len(emails), batch_size)]
+            ids = [[e.partition('@')[0] for e in batch] for batch in batches]
             c = 0
-            for reservation in filter(self.report_filter, report):
-                if not self.includes(reservation['Email']):
-                    id = reservation['Email'].split('@')[0]
-                    patron_type = IDCache.get_patron_type(id)
-                    print(f'Adding {id} to cache')
-                    self[patron_type].append(reservation['Email'])
-                    c+=1
-                    if c % dump_every == 0: self._dumpload()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # Lookups are all network wait, so run them in threads, but
+                # update the cache from here, in order, as results come back
+                lookup = IDCache.get_patron_types if batch else IDCache._get_patron_types_singly
+                results = pool.map(lookup, ids)
+                try:
+                    for batch_emails, batch_ids, patron_types in zip(batches, ids, results):
+                        for email, id in zip(batch_emails, batch_ids):
+                            self.add(email, patron_types[id])
+                            c+=1
+                            if c % dump_every == 0: self._dump()
+                        print(f'Added {c} of {len(emails)} IDs to cache')
+                except:
+                    # map queued every batch up front; don't run the rest
+                    # against a server that's failing
+                    pool.shutdown(cancel_futures=True)
+                    raise
         except:
             self._dump()
             raise
         self._dump()
 
-    def _dumpload(self):
-        self._dump()
-        self.clear()
-        self._load()
-
     @staticmethod
     def get_patron_type(id):
         query = IDCache._build_query(id, 'uid')
@@ -84,9 +208,46 @@ class IDCache(defaultdict, SeatDataReader):
             query = IDCache._build_query(id, 'mail')
             patron_type = IDCache._run_query(query)
         if patron_type is None: # still
-            patron_type = 'unknown'
+            patron_type = IDCache.UNKNOWN
         return patron_type
 
+    @staticmethod
+    def _get_patron_types_singly(ids):
+        # get_patron_types, but with one get_patron_type per id
+        return {id: IDCache.get_patron_type(id) for id in ids}
+
+    @staticmethod
+    def get_patron_types(ids):
+        '''Like get_patron_type, but for a list of ids. Asks LDAP about all of
+        them at once by uid, and then about any misses by mail. Returns a dict
+        of id -> patron type.
+        '''
+        patron_types = {}
+        # LDAP matching ignores case, so several of our ids can match one entry
+        wanted = {}
+        for id in ids:
+            wanted.setdefault(id.lower(), []).append(id)
+        query = IDCache._build_batch_query(ids, 'uid')
+        for entry in IDCache._run_batch_query(query):
+            for uid in entry['uid']:
+                if entry['pustatus']:
+                    for id in wanted.get(uid.lower(), ()):
+                        patron_types[id] = entry['pustatus'][0]
+        residue = [id for id in ids if id not in patron_types]
+        if residue: # might be email aliases
+            wanted = {}
+            for id in residue:
+                wanted.setdefault(f'{id}@princeton.edu'.lower(), []).append(id)
+            query = IDCache._build_batch_query(residue, 'mail')
+            for entry in IDCache._run_batch_query(query):
+                for mail in entry['mail']:
+                    if entry['pustatus']:
+                        for id in wanted.get(mail.lower(), ()):
+                            patron_types[id] = entry['pustatus'][0]
+        for id in ids: # still
+            patron_types.setdefault(id, IDCache.UNKNOWN)
+        return patron_types
+
     @staticmethod
     def _build_query(id, field):
         # Build the elements of an ldapsearch command
@@ -95,108 +256,157 @@ class IDCache(defaultdict, SeatDataReader):
             filter = f'{filter}@princeton.edu'
         return ['ldapsearch', '-h', 'ldap.princeton.edu', '-p', '389', '-x', '-b', 'o=Princeton University,c=US', filter]
 
+    @staticmethod
+    def _build_batch_query(ids, field):
+        # Like _build_query, but ORs the ids together and only asks for the
+        # attributes get_patron_types needs
+        suffix = '@princeton.edu' if field == 'mail' else ''
+        terms = ''.join(f'({field}={IDCache._escape(id)}{suffix})' for id in ids)
+        return ['ldapsearch', '-h', 'ldap.princeton.edu', '-p', '389', '-x', '-b', 'o=Princeton University,c=US', f'(|{terms})', field, 'pustatus']
+
+    @staticmethod
+    def _escape(value):
+        # RFC 4515 escapes, so one odd id can't break the whole filter
+        for c in '\\*()\0':
+            value = value.replace(c, f'\\{ord(c):02x}')
+        return value
+
     @staticmethod
     def _run_query(q):
-        # Shell out to ldapsearch. Right now just returns a string with the
-        # status, but the intermediate dict could be useful in the future.
+        # Shell out to ldapsearch and pick the status out of the output
         proc = Popen(q, stderr=PIPE, stdout=PIPE)
         stdout, stderr = proc.communicate()
-        d = {}
-        for line in stdout.decode('utf-8', errors='ignore').strip().split("\n"):
-            if ':' in line:
-                tokens = line.split(':')
-                k = tokens[0]
-                if len(tokens) == 2:
-                    d[k] = tokens[1].strip()
-                else:
-                    d[k] = ':'.join(tokens[1:]).strip()
-        return d.get('pustatus')
+        if proc.returncode != 0: # don't mistake a failed search for a miss
+            raise CalledProcessError(proc.returncode, q, stdout, stderr)
+        m = IDCache._PUSTATUS_RE.search(stdout)
+        return m.group(1).decode('utf-8', errors='ignore') if m else None
+
+    @staticmethod
+    def _run_batch_query(q):
+        # Like _run_query, but ldapsearch output can hold many entries, so
+        # returns a list of dicts (one per entry) of attribute -> list of values
+        proc = Popen(q, stderr=PIPE, stdout=PIPE)
+        stdout, stderr = proc.communicate()
+        if proc.returncode != 0: # don't mistake a failed search for a miss
+            raise CalledProcessError(proc.returncode, q, stdout, stderr)
+        entries = []
+        for block in stdout.split(b"\n\n"):
+            d = defaultdict(list)
+            for k, v in IDCache._ATTRIBUTE_RE.findall(block):
+                d[k.decode()].append(v.decode('utf-8', errors='ignore'))
+            entries.append(d)
+        return entries
 
 class DayTimeReporter(SeatDataReader):
+    __slots__ = ('id_cache', 'reservations', 'counts', 'data', 'json_dump_fp', 'csv_dump_fp')
+
     def __init__(self, id_cache):
         self.id_cache = id_cache
+        self.reservations = Counter() # (day, location, time block, email) -> count
+        self.counts = Counter() # (day, location, time block, patron type) -> count
         self.data = {}
         self.json_dump_fp = './report.json'
         self.csv_dump_fp = './report.csv'
-        self.days = ('Monday','Tuesday','Wednesday','Thursday','Friday','Saturday','Sunday')
-
-    def run(self, report_path):
-        report = self.read_report(report_path)
-        for res in filter(self.report_filter, report):
-            day = DayTimeReporter._day_from_reservation(res)
-            if day not in self.data:
-                self.data[day] = {}
-            location = res['Location']
-            if location not in self.data[day]:
-                self.data[day][location] = {}
-            time_block = DayTimeReporter._time_key_from_reservation(res)
-            if time_block not in self.data[day][location]:
-                self.data[day][location][time_block] = {}
-            patron_type = self._patron_type_from_reservation(res)
-            if patron_type not in self.data[day][location][time_block]:
-                self.data[day][location][time_block][patron_type] = 1
-            else:
-                self.data[day][location][time_block][patron_type] +=1
-        self.data = DayTimeReporter._sort_report(self.data)
-        for i in range(0,7): # turn ints into days of the week
-            day = self.days[i]
-            self.data[day] = self.data.pop(i)
+
+    def run(self, report_path, workers=1):
+        '''Counts the reservations in the report and dumps the results. See
+        count() for workers.
+        '''
+        self.count(report_path, workers)
+        self.finalize()
+
+    def count(self, report_path, workers=1):
+        '''Counts the reservations in the report, by email; call finalize()
+        once the ID cache knows them all. With workers > 1, the report is split
+        into that many chunks which are counted in separate processes and then
+        merged.
+        '''
+        if workers > 1:
+            chunks = [(report_path, start, end)
+                for start, end in self.chunk_offsets(report_path, workers)]
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for reservations in pool.map(DayTimeReporter._count, chunks):
+                    self.reservations.update(reservations)
+        else:
+            self.reservations.update(DayTimeReporter._count((report_path, None, None)))
+
+    def finalize(self):
+        '''Rolls the counted reservations up by patron type, which the ID cache
+        must know by now, and dumps the results.
+        '''
+        self.counts = Counter()
+        for (day, location, time_block, email), count in self.reservations.items():
+            self.counts[(day, location, time_block, self.id_cache.patron_type(email))] += count
+        self.data = DayTimeReporter._nest(self.counts)
         self._dump('json')
         self._dump('csv')
 
     @staticmethod
-    def _sort_report(d):
-        tmp = {}
-        for k, v in sorted(d.items()):
-            if isinstance(v, dict):
-                #recursive case
-                tmp[k] = DayTimeReporter._sort_report(v)
-            else:
-                tmp[k] = v
-        return tmp
+    def _count(args):
+        # Takes one tuple of args so it can be handed to ProcessPoolExecutor.map
+        report_path, start, end = args
+        reservations = SeatDataReader().iter_report(report_path, start, end)
+        # Counter tallies an iterable in C, i.e. a group by and count
+        return Counter(map(DayTimeReporter._key_from_reservation, reservations))
+
+    @staticmethod
+    def _key_from_reservation(res):
+        # Counted by email rather than patron type so counting doesn't have to
+        # wait on the ID cache
+        day = DayTimeReporter._day_from_reservation(res)
+        time_block = DayTimeReporter._time_key_from_reservation(res)
+        return (day, res[LOCATION], time_block, res[EMAIL])
+
+    @staticmethod
+    def _nest(counts):
+        # Regroups the flat counts into the day -> location -> time block ->
+        # patron type dicts we dump. Inserting in sorted order is enough to
+        # sort every level, and keeps days in weekday (not alphabetical) order
+        data = {}
+        for (day, location, time_block, patron_type), count in sorted(counts.items()):
+            data.setdefault(DAYS[day], {}).setdefault(location, {}).setdefault(time_block, {})[patron_type] = count
+        return data
 
     def _dump(self, fmt):
         if fmt == 'json':
-            with open(self.json_dump_fp, 'w') as f:
-                dump(self.data, f, ensure_ascii=False, indent=2)
+            write_json(self.data, self.json_dump_fp)
         if fmt == 'csv':
             self._dump_csv()
 
     def _dump_csv(self):
-        # 😒
         fields = ('Day', 'Location', 'Time Block', 'Patron Type', 'Count')
+        lines = ((DAYS[day], location, time_block, patron_type, count)
+            for (day, location, time_block, patron_type), count in sorted(self.counts.items()))
         with open(self.csv_dump_fp, 'w') as f:
             csv_writer = writer(f, dialect='excel')
             csv_writer.writerow(fields)
-            for day in self.data.keys():
-                for location in self.data[day].keys():
-                    for time_block in self.data[day][location].keys():
-                        for patron_type in self.data[day][location][time_block].keys():
-                            count = self.data[day][location][time_block][patron_type]
-                            line = (day, location, time_block, patron_type, count)
-                            csv_writer.writerow(line)
+            csv_writer.writerows(lines)
 
     @staticmethod
     def _time_key_from_reservation(res):
-        hour = int(res['From Time'].split(':')[0])
-        if hour % 2 == 1:
-            hour-=1
-        return f'{str(hour).zfill(2)}:00 - {str(hour+1).zfill(2)}:59'
+        return TIME_BLOCKS[int(res[FROM_TIME].partition(':')[0])]
 
     @staticmethod
     def _day_from_reservation(res):
         # Uses zero-based/non-ISO, i.e. 0 = Monday, 6 = Sunday
-        return date(*map(int, res['From Date'].split('-'))).weekday()
+        return DayTimeReporter._weekday(res[FROM_DATE])
 
-    def _patron_type_from_reservation(self, reservation):
-        return id_cache.patron_type(reservation['Email'])
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _weekday(from_date):
+        # Reports cover a few months at most, so nearly every call is a hit
+        return date(*map(int, from_date.split('-'))).weekday()
 
 
 if __name__ == '__main__':
     pth = 'seats_feb1_mar19.csv'
-    ##  Build an ID cache:
     id_cache = IDCache()
-    id_cache.build(pth)
-    ## Run the report:
     reporter = DayTimeReporter(id_cache)
-    reporter.run(pth)
+    ## Read the report once, counting reservations by email in parallel:
+    reporter.count(pth, workers=cpu_count() or 1) # None if it can't tell
+    ## Build the ID cache from the emails counted (hits LDAP for new ones):
+    for day, location, time_block, email in reporter.reservations:
+        id_cache.observe_id(email)
+    id_cache.resolve()
+    ## Run the report:
+    reporter.finalize()